@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional
+
+try:
+    import fcntl  # POSIX only; without it the state file is updated unlocked
+except ImportError:
+    fcntl = None
+
+
+# --- CONFIG ---
+# Every OCR run is its own Python process spawned by the Node workers, so the
+# breaker state lives in a small JSON file shared by all of them.
+STATE_PATH = os.getenv(
+    'GEMINI_BREAKER_STATE',
+    os.path.join(tempfile.gettempdir(), 'gemini_circuit_breaker.json'),
+)
+WINDOW_SECONDS = float(os.getenv('GEMINI_BREAKER_WINDOW', '120'))
+MIN_CALLS = int(os.getenv('GEMINI_BREAKER_MIN_CALLS', '4'))
+FAILURE_RATIO = float(os.getenv('GEMINI_BREAKER_FAILURE_RATIO', '0.5'))
+COOLDOWN_SECONDS = float(os.getenv('GEMINI_BREAKER_COOLDOWN', '60'))
+# A half-open probe that has not reported back after this long is considered lost
+PROBE_TIMEOUT_SECONDS = float(os.getenv('GEMINI_BREAKER_PROBE_TIMEOUT', '90'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Ticket handed out by allow_request() for ordinary calls; probes get a unique id
+CALL_TICKET = 'call'
+
+
+def _empty_state() -> Dict[str, Any]:
+    return {'state': CLOSED, 'opened_at': None, 'probe_id': None, 'probe_started_at': None, 'events': []}
+
+
+def _load(f) -> Dict[str, Any]:
+    try:
+        f.seek(0)
+        state = json.load(f)
+    except ValueError:
+        return _empty_state()
+    return state if isinstance(state, dict) else _empty_state()
+
+
+@contextmanager
+def _locked_state() -> Iterator[Dict[str, Any]]:
+    """Yield the shared breaker state under an exclusive lock and write it back."""
+    with open(STATE_PATH + '.lock', 'a+') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(STATE_PATH, 'r') as f:
+                    state = _load(f)
+            except OSError:
+                state = _empty_state()
+            yield state
+            tmp_path = STATE_PATH + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, STATE_PATH)
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_state() -> Dict[str, Any]:
+    """Read the shared state under a shared lock, without writing it back."""
+    with open(STATE_PATH + '.lock', 'a+') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            try:
+                with open(STATE_PATH, 'r') as f:
+                    return _load(f)
+            except OSError:
+                return _empty_state()
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _record(ticket: Optional[str], ok: bool) -> None:
+    now = time.time()
+    try:
+        with _locked_state() as state:
+            events = [e for e in state.get('events', []) if now - e[0] <= WINDOW_SECONDS]
+            events.append([now, ok])
+            state['events'] = events
+            current = state.get('state', CLOSED)
+
+            if current == HALF_OPEN:
+                # only the probe decides; stragglers from before the breaker opened do not
+                if ticket is None or ticket != state.get('probe_id'):
+                    return
+                state['probe_id'] = None
+                state['probe_started_at'] = None
+                if ok:
+                    state['state'] = CLOSED
+                    state['opened_at'] = None
+                    state['events'] = []
+                else:
+                    state['state'] = OPEN
+                    state['opened_at'] = now
+                return
+
+            if current != CLOSED:
+                # already open: keep the cooldown anchored to when it opened
+                return
+
+            failures = sum(1 for e in events if not e[1])
+            if len(events) >= MIN_CALLS and failures / len(events) >= FAILURE_RATIO:
+                sys.stderr.write(f'Gemini circuit breaker opened ({failures}/{len(events)} recent calls failed)\n')
+                state['state'] = OPEN
+                state['opened_at'] = now
+    except OSError as e:
+        sys.stderr.write(f'Circuit breaker state unavailable: {e}\n')
+
+
+PROBE = 'probe'
+
+
+def _decide(state: Dict[str, Any], now: float) -> Optional[str]:
+    """Return CALL_TICKET, None (skip) or PROBE (a probe slot is free to claim)."""
+    current = state.get('state', CLOSED)
+    if current == CLOSED:
+        return CALL_TICKET
+    if current == OPEN and now - (state.get('opened_at') or 0) < COOLDOWN_SECONDS:
+        return None
+    # half-open: only one probe at a time; a probe that never reported back is replaced
+    started = state.get('probe_started_at')
+    if current == HALF_OPEN and started and now - started < PROBE_TIMEOUT_SECONDS:
+        return None
+    return PROBE
+
+
+def allow_request() -> Optional[str]:
+    """Return a ticket if a Gemini call may go out now, or None to skip it.
+
+    When half-open, at most one caller across all workers gets a probe ticket;
+    pass the ticket back to record_success()/record_failure().
+    """
+    now = time.time()
+    try:
+        # the common answers only need a shared read; the file is rewritten just to claim a probe
+        decision = _decide(_read_state(), now)
+        if decision != PROBE:
+            return decision
+        with _locked_state() as state:
+            # another worker may have claimed the probe since the read above
+            decision = _decide(state, now)
+            if decision != PROBE:
+                return decision
+            state['state'] = HALF_OPEN
+            state['probe_id'] = uuid.uuid4().hex
+            state['probe_started_at'] = now
+            return state['probe_id']
+    except OSError as e:
+        sys.stderr.write(f'Circuit breaker state unavailable: {e}\n')
+        return CALL_TICKET
+
+
+def record_success(ticket: Optional[str] = CALL_TICKET) -> None:
+    _record(ticket, True)
+
+
+def record_failure(ticket: Optional[str] = CALL_TICKET) -> None:
+    _record(ticket, False)
+
+
+def current_state() -> str:
+    """Return the breaker state as seen right now: closed, open or half_open."""
+    try:
+        state = _read_state()
+    except OSError:
+        return CLOSED
+    current = state.get('state', CLOSED)
+    if current == OPEN and time.time() - (state.get('opened_at') or 0) >= COOLDOWN_SECONDS:
+        return HALF_OPEN
+    return current
@@ -0,0 +1,71 @@
+import os
+import sys
+import requests
+from typing import Optional, Dict, Any, List
+
+import circuit_breaker
+
+
+# --- CONFIG ---
+MODEL = "models/gemini-2.5-pro"
+# Model ladder, cheapest first; escalate to the next tier only when validation fails.
+# Override with GEMINI_MODEL_TIERS="models/a,models/b" or --models.
+DEFAULT_MODEL_TIERS = ["models/gemini-2.5-flash", MODEL]
+
+
+def parse_model_tiers(raw: str) -> List[str]:
+    return [m.strip() for m in (raw or '').split(',') if m.strip()]
+
+
+def load_model_tiers() -> List[str]:
+    """Load the model ladder from GEMINI_MODEL_TIERS, falling back to the defaults."""
+    return parse_model_tiers(os.getenv('GEMINI_MODEL_TIERS', '')) or list(DEFAULT_MODEL_TIERS)
+
+
+# Shared by both OCR scripts; set_model_tiers() updates it in place so imports stay valid
+MODEL_TIERS = load_model_tiers()
+
+
+def set_model_tiers(raw: str) -> None:
+    """Apply a comma-separated --models override; empty input keeps the current ladder."""
+    tiers = parse_model_tiers(raw)
+    if tiers:
+        MODEL_TIERS[:] = tiers
+
+
+def post_to_gemini(api_key: str, payload: Dict[str, Any], timeout: int = 30,
+                   model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    # default to the top of the ladder
+    model = model or MODEL_TIERS[-1]
+    url = f"https://generativelanguage.googleapis.com/v1beta/{model}:generateContent?key={api_key}"
+    headers = {"Content-Type": "application/json"}
+    # fail fast while the endpoint is degraded instead of waiting out the timeout
+    ticket = circuit_breaker.allow_request()
+    if ticket is None:
+        sys.stderr.write('Gemini circuit breaker open; skipping request\n')
+        return None
+    # stdout carries only the JSON result for the Node controllers, so diagnostics go to stderr.
+    # Each ticket gets exactly one outcome recorded.
+    try:
+        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        circuit_breaker.record_failure(ticket)
+        sys.stderr.write(f"Gemini request failed: {e!r}\n")
+        return None
+    if resp.status_code != 200:
+        # only throttling and server errors mean the endpoint itself is unhealthy
+        if resp.status_code == 429 or resp.status_code >= 500:
+            circuit_breaker.record_failure(ticket)
+        else:
+            circuit_breaker.record_success(ticket)
+        sys.stderr.write(f"Gemini API error: status={resp.status_code}\n{resp.text}\n")
+        return None
+    try:
+        body = resp.json()
+    except ValueError as e:
+        # a garbled 200 is a degraded endpoint too
+        circuit_breaker.record_failure(ticket)
+        sys.stderr.write(f"Gemini returned a non-JSON body: {e!r}\n")
+        return None
+    circuit_breaker.record_success(ticket)
+    return body
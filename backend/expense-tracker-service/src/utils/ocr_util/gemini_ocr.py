@@ -1,15 +1,22 @@
 import base64
 import os
-import requests
 import json
 import argparse
-from typing import Optional, Dict, Any
+import re
+import sys
+from typing import Optional, Dict, Any, List
 from PIL import Image
 import pytesseract
 
+import circuit_breaker
+from gemini_client import MODEL_TIERS, post_to_gemini, set_model_tiers
+
 
 # --- CONFIG ---
-MODEL = "models/gemini-2.5-pro"
+# Max receipts packed into one batched request
+BATCH_SIZE = 8
+# Keep batched requests well under Gemini's 20MB inline request limit
+MAX_BATCH_PAYLOAD_BYTES = 15 * 1024 * 1024
 
 # --- EXPENSE CATEGORIES ---
 EXPENSE_SUBCLASSES = [
@@ -69,21 +76,6 @@ def encode_image(image_path: str) -> str:
         return base64.b64encode(f.read()).decode('utf-8')
 
 
-def post_to_gemini(api_key: str, payload: Dict[str, Any], timeout: int = 30) -> Optional[Dict[str, Any]]:
-    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL}:generateContent?key={api_key}"
-    headers = {"Content-Type": "application/json"}
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        if resp.status_code != 200:
-            print(f"Gemini API error: status={resp.status_code}")
-            print(resp.text)
-            return None
-        return resp.json()
-    except requests.exceptions.RequestException as e:
-        print("Gemini request failed:", repr(e))
-        return None
-
-
 def extract_text_from_response(body: Dict[str, Any]) -> Optional[str]:
     candidates = body.get('candidates', [])
     if not candidates:
@@ -122,6 +114,28 @@ def extract_json_from_text(t: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+def extract_json_array_from_text(t: str) -> Optional[List[Any]]:
+    t = t.strip()
+    # try first JSON array (also covers fenced output)
+    start = t.find('[')
+    end = t.rfind(']')
+    if start != -1 and end != -1 and end > start:
+        candidate = t[start:end+1]
+        try:
+            parsed = json.loads(candidate)
+            if isinstance(parsed, list):
+                return parsed
+        except Exception:
+            pass
+    # model may wrap the array in an object
+    obj = extract_json_from_text(t)
+    if isinstance(obj, dict):
+        for key in ('receipts', 'results'):
+            if isinstance(obj.get(key), list):
+                return obj[key]
+    return None
+
+
 def is_valid_category(c: Any) -> bool:
     return isinstance(c, str) and c in EXPENSE_SUBCLASSES
 
@@ -131,16 +145,32 @@ def parsed_has_item_categories(p: Dict[str, Any]) -> bool:
     if not isinstance(items, list):
         return False
     for it in items:
-        if not is_valid_category(it.get('category')):
+        if not isinstance(it, dict) or not is_valid_category(it.get('category')):
             return False
     return True
 
 
+def receipt_escalation_reason(p: Dict[str, Any]) -> Optional[str]:
+    """Return why a parsed receipt should go to the next model tier, or None to accept it."""
+    if not is_valid_category(p.get('category')):
+        return 'invalid overall category'
+    if not parsed_has_item_categories(p):
+        return 'invalid item categories'
+    return None
+
+
+def tag_model_tier(obj: Dict[str, Any], tier: int, escalations: List[str]) -> Dict[str, Any]:
+    obj['model'] = MODEL_TIERS[tier]
+    obj['model_tier'] = tier
+    obj['model_escalations'] = escalations
+    return obj
+
+
 def ensure_categories(obj: Dict[str, Any], source: str, reason: str) -> Dict[str, Any]:
     changed = False
     items = obj.get('items') or []
     for it in items:
-        if not is_valid_category(it.get('category')):
+        if isinstance(it, dict) and not is_valid_category(it.get('category')):
             it['category'] = 'other_expenses'
             changed = True
     if not is_valid_category(obj.get('category')):
@@ -177,6 +207,48 @@ def build_initial_payload(image_base64: str) -> Dict[str, Any]:
     return payload
 
 
+def build_batch_payload(images_base64: List[str]) -> Dict[str, Any]:
+    categories_text = ", ".join(EXPENSE_SUBCLASSES)
+    prompt = (
+        f"You will be given {len(images_base64)} receipt images (inline), each preceded by its image_index."
+        " Extract structured receipt data from EACH image and return a single JSON array (no explanatory text)"
+        " with exactly one object per image. Each object must have the following fields:\n"
+        "- image_index (integer, the index given before the image)\n"
+        "- merchant (string)\n- date (ISO or obvious string)\n- items: list of {name, qty, price, category}\n"
+        "- total (raw total from receipt if present)\n- amount_paid (final numeric amount paid)\n"
+        "- category (choose exactly one from the allowed list)\n\n"
+        f"The allowed categories are: {categories_text}.\n"
+        "For EACH item include a 'category' field whose value is exactly one of the allowed categories.\n"
+        "Also choose the most suitable single overall 'category' for each receipt from the same allowed list.\n"
+        "Never merge data from different images into one object.\n"
+        "Respond ONLY with a valid JSON array. Do not wrap in markdown."
+    )
+    parts: List[Dict[str, Any]] = [{"text": prompt}]
+    for idx, image_base64 in enumerate(images_base64):
+        parts.append({"text": f"image_index: {idx}"})
+        parts.append({"inline_data": {"mime_type": "image/png", "data": image_base64}})
+    return {"contents": [{"parts": parts}]}
+
+
+def plan_batches(images_base64: List[str], batch_size: int = BATCH_SIZE,
+                 max_bytes: int = MAX_BATCH_PAYLOAD_BYTES) -> List[List[int]]:
+    """Group image indices into batches bounded by count and encoded payload size."""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_bytes = 0
+    for idx, image_base64 in enumerate(images_base64):
+        size = len(image_base64)
+        if current and (len(current) >= batch_size or current_bytes + size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(idx)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
 def reprompt_for_full_categories(api_key: str, parsed: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     prompt = (
         "You will be given a parsed receipt JSON object. Return a single JSON object"
@@ -221,7 +293,7 @@ def fallback_local_categories(parsed: Dict[str, Any]) -> Dict[str, Any]:
             break
     items = parsed.get('items') or []
     for it in items:
-        if not is_valid_category(it.get('category')):
+        if isinstance(it, dict) and not is_valid_category(it.get('category')):
             it['category'] = fallback_category
     parsed['category'] = fallback_category
     parsed['category_source'] = 'local_fallback'
@@ -234,19 +306,33 @@ def fallback_tesseract(image_path: str) -> str:
     return pytesseract.image_to_string(img)
 
 
-def process_image(api_key: str, image_path: str) -> Optional[Dict[str, Any]]:
-    image_base64 = encode_image(image_path)
-    payload = build_initial_payload(image_base64)
-    body = post_to_gemini(api_key, payload, timeout=30)
-    if not body:
-        return None
-    text = extract_text_from_response(body)
-    if not text:
-        return None
-    parsed = extract_json_from_text(text)
-    if not isinstance(parsed, dict):
-        return {'raw_text': text}
+def parse_receipt_text_locally(text: str) -> Dict[str, Any]:
+    """Best-effort receipt fields from raw OCR text, used when Gemini is unavailable."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    total = None
+    for line in reversed(lines):
+        if 'total' in line.lower():
+            amounts = re.findall(r'\d+[.,]\d{2}', line)
+            if amounts:
+                total = float(amounts[-1].replace(',', '.'))
+                break
+    date_match = re.search(r'\b(\d{4}-\d{2}-\d{2}|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})\b', text)
+    return {
+        'merchant': lines[0] if lines else '',
+        'date': date_match.group(1) if date_match else None,
+        'items': [],
+        'total': total,
+        'amount_paid': total,
+        'raw_text': text,
+    }
 
+
+def process_image_locally(image_path: str) -> Dict[str, Any]:
+    """Tesseract + local categories, with no Gemini calls."""
+    return fallback_local_categories(parse_receipt_text_locally(fallback_tesseract(image_path)))
+
+
+def finalize_parsed(api_key: str, parsed: Dict[str, Any]) -> Dict[str, Any]:
     # accept if valid
     if is_valid_category(parsed.get('category')) and parsed_has_item_categories(parsed):
         parsed['category_source'] = 'gemini'
@@ -264,18 +350,169 @@ def process_image(api_key: str, image_path: str) -> Optional[Dict[str, Any]]:
     return fallback_local_categories(parsed)
 
 
+def process_image(api_key: str, image_path: str, start_tier: int = 0,
+                  image_base64: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    if image_base64 is None:
+        image_base64 = encode_image(image_path)
+    payload = build_initial_payload(image_base64)
+    parsed: Optional[Dict[str, Any]] = None
+    parsed_tier = start_tier
+    raw_text: Optional[str] = None
+    raw_tier = start_tier
+    escalations: List[str] = []
+    for tier in range(start_tier, len(MODEL_TIERS)):
+        model = MODEL_TIERS[tier]
+        body = post_to_gemini(api_key, payload, timeout=30, model=model)
+        text = extract_text_from_response(body) if body else None
+        if not body:
+            # The endpoint failed, not the model; a bigger model would only wait longer
+            escalations.append(f'{model}: no response')
+            break
+        if not text:
+            escalations.append(f'{model}: empty response')
+            continue
+        candidate = extract_json_from_text(text)
+        if not isinstance(candidate, dict):
+            if raw_text is None:
+                raw_text, raw_tier = text, tier
+            escalations.append(f'{model}: unparseable JSON')
+            continue
+        parsed, parsed_tier = candidate, tier
+        reason = receipt_escalation_reason(candidate)
+        if reason is None:
+            break
+        escalations.append(f'{model}: {reason}')
+
+    if parsed is None:
+        return tag_model_tier({'raw_text': raw_text}, raw_tier, escalations) if raw_text else None
+    return tag_model_tier(finalize_parsed(api_key, parsed), parsed_tier, escalations)
+
+
+def parse_image_index(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def map_batch_entries(entries: List[Any], count: int) -> Dict[int, Dict[str, Any]]:
+    """Key batch entries by image_index; entries without a usable index count as missing.
+
+    Position is only trusted when the model returned exactly one entry per image
+    and indexed none of them, since a dropped receipt would shift the rest.
+    """
+    by_index: Dict[int, Dict[str, Any]] = {}
+    positional = len(entries) == count and not any(
+        isinstance(e, dict) and 'image_index' in e for e in entries
+    )
+    for pos, entry in enumerate(entries):
+        if not is_batch_entry_valid(entry):
+            continue
+        idx = pos if positional else parse_image_index(entry.pop('image_index', None))
+        if idx is not None and 0 <= idx < count and idx not in by_index:
+            by_index[idx] = entry
+    return by_index
+
+
+def is_batch_entry_valid(entry: Any) -> bool:
+    if not isinstance(entry, dict):
+        return False
+    if not any(entry.get(k) is not None for k in ('merchant', 'items', 'total', 'amount_paid')):
+        return False
+    items = entry.get('items')
+    if items is None:
+        return True
+    return isinstance(items, list) and all(isinstance(it, dict) for it in items)
+
+
+def process_image_batch(api_key: str, image_paths: List[str],
+                        images_base64: Optional[List[str]] = None) -> List[Optional[Dict[str, Any]]]:
+    """Send several receipts in one request; missing or invalid entries are retried one by one."""
+    if images_base64 is None:
+        images_base64 = [encode_image(p) for p in image_paths]
+    if len(image_paths) == 1:
+        return [process_image(api_key, image_paths[0], image_base64=images_base64[0])]
+
+    payload = build_batch_payload(images_base64)
+    # scale the timeout with the number of images, as one request now does N receipts of work
+    body = post_to_gemini(api_key, payload, timeout=30 + 10 * (len(image_paths) - 1), model=MODEL_TIERS[0])
+    text = extract_text_from_response(body) if body else None
+    entries = extract_json_array_from_text(text) if text else None
+    by_index = map_batch_entries(entries or [], len(image_paths))
+
+    results: List[Optional[Dict[str, Any]]] = []
+    for idx, image_path in enumerate(image_paths):
+        entry = by_index.get(idx)
+        if entry is None:
+            results.append(process_image(api_key, image_path, image_base64=images_base64[idx]))
+            continue
+        reason = receipt_escalation_reason(entry)
+        if reason is not None and len(MODEL_TIERS) > 1:
+            # the batch ran on the first tier; escalate this receipt alone
+            res = process_image(api_key, image_path, start_tier=1, image_base64=images_base64[idx])
+            if res is not None and 'model_escalations' in res:
+                res['model_escalations'].insert(0, f'{MODEL_TIERS[0]} (batch): {reason}')
+                results.append(res)
+                continue
+        escalations = [f'{MODEL_TIERS[0]} (batch): {reason}'] if reason else []
+        results.append(tag_model_tier(finalize_parsed(api_key, entry), 0, escalations))
+    return results
+
+
+def process_images(api_key: str, image_paths: List[str], batch_size: int = BATCH_SIZE,
+                   max_bytes: int = MAX_BATCH_PAYLOAD_BYTES) -> List[Optional[Dict[str, Any]]]:
+    """Process many receipts, packing them into as few Gemini requests as the limits allow."""
+    images_base64 = [encode_image(p) for p in image_paths]
+    results: List[Optional[Dict[str, Any]]] = [None] * len(image_paths)
+    for batch in plan_batches(images_base64, max(1, batch_size), max_bytes):
+        batch_results = process_image_batch(
+            api_key,
+            [image_paths[i] for i in batch],
+            [images_base64[i] for i in batch],
+        )
+        for i, res in zip(batch, batch_results):
+            results[i] = res
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description='Receipt OCR + categorization using Gemini')
-    parser.add_argument('image', nargs='?', help='Path to receipt image')
+    parser.add_argument('image', nargs='*', help='Path(s) to receipt image(s)')
     parser.add_argument('--save', '-s', help='Path to save JSON output')
+    parser.add_argument('--batch-size', '-b', type=int, default=BATCH_SIZE,
+                        help='Max receipts per Gemini request when several images are given')
+    parser.add_argument('--models', help='Comma-separated model ladder, cheapest first')
     args = parser.parse_args()
 
+    if args.models:
+        set_model_tiers(args.models)
+
     api_key = load_api_key()
     if not api_key:
         print('No GEMINI_API_KEY found in environment or .env')
         return
 
-    image_path = args.image
+    if len(args.image) > 1:
+        results = process_images(api_key, args.image, batch_size=args.batch_size)
+        output = []
+        for image_path, result in zip(args.image, results):
+            if result is None:
+                result = process_image_locally(image_path)
+            result['image'] = image_path
+            result['circuit_breaker'] = circuit_breaker.current_state()
+            output.append(result)
+        out = json.dumps(output, indent=2)
+        print(out)
+        if args.save:
+            with open(args.save, 'w') as f:
+                f.write(out)
+            print(f'Saved output to {args.save}')
+        return
+
+    image_path = args.image[0] if args.image else None
     if not image_path:
         try:
             image_path = input('Enter path to receipt image: ').strip()
@@ -288,9 +525,9 @@ def main():
 
     result = process_image(api_key, image_path)
     if result is None:
-        print('Failed to get a response from Gemini; falling back to Tesseract output:')
-        print(fallback_tesseract(image_path))
-        return
+        sys.stderr.write('Failed to get a response from Gemini; falling back to Tesseract output\n')
+        result = process_image_locally(image_path)
+    result['circuit_breaker'] = circuit_breaker.current_state()
 
     out = json.dumps(result, indent=2)
     print(out)
@@ -1,16 +1,27 @@
 import base64
 import os
-import requests
 import json
 import argparse
 import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 import fitz  # PyMuPDF for PDF processing
 import re
 import sys
+import concurrent.futures
+from PIL import Image
+import pytesseract
+
+import circuit_breaker
+from gemini_client import MODEL_TIERS, post_to_gemini, set_model_tiers
 
 # --- CONFIG ---
-MODEL = "models/gemini-2.5-pro"
+# Escalate when more than this share of transactions come back with confidence "low"
+MAX_LOW_CONFIDENCE_RATIO = 0.3
+# Returned by the process_statement_with_* helpers when Gemini itself did not answer
+# (timeout, 5xx, breaker open), as opposed to answering with something unusable
+NO_RESPONSE: Dict[str, Any] = {'error': 'no response'}
+# Characters of statement text that go into one prompt
+STATEMENT_TEXT_LIMIT = 8000
 
 # --- INCOME AND EXPENSE CATEGORIES ---
 INCOME_SUBCLASSES = [
@@ -62,6 +73,16 @@ EXPENSE_SUBCLASSES = [
 
 ALL_CATEGORIES = INCOME_SUBCLASSES + EXPENSE_SUBCLASSES
 
+# --- LOCAL OCR (scanned PDFs without a text layer) ---
+OCR_DPI = int(os.getenv('OCR_DPI', '300'))
+OCR_PAGE_TIMEOUT = int(os.getenv('OCR_PAGE_TIMEOUT', '60'))
+# Size the pool from the CPUs this process may actually run on (container cpusets), not the host
+try:
+    AVAILABLE_CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    AVAILABLE_CPUS = os.cpu_count() or 1
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '0')) or AVAILABLE_CPUS
+
 def load_api_key(env_path: str = '.env') -> Optional[str]:
     """Load GEMINI_API_KEY from the environment or a .env file."""
     key = os.getenv('GEMINI_API_KEY')
@@ -94,6 +115,90 @@ def extract_text_from_pdf(pdf_path: str) -> str:
         print(f"Error extracting text from PDF: {e}")
         return ""
 
+def ocr_pdf_page(pdf_path: str, page_index: int, dpi: int = OCR_DPI,
+                 timeout: int = OCR_PAGE_TIMEOUT) -> Dict[str, Any]:
+    """Rasterize one PDF page and OCR it with Tesseract, keeping word boxes.
+
+    Runs inside a worker process, so it reopens the PDF itself. Word boxes are
+    returned as [x0, y0, x1, y1] in PDF points, the same space PyMuPDF uses.
+    """
+    page_result = {'page': page_index + 1, 'text': '', 'words': []}
+    try:
+        doc = fitz.open(pdf_path)
+        pix = doc[page_index].get_pixmap(dpi=dpi)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        doc.close()
+    except Exception as e:
+        page_result['error'] = f'Could not render page: {e}'
+        return page_result
+    try:
+        data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT, timeout=timeout)
+    except pytesseract.TesseractError as e:
+        page_result['error'] = f'OCR failed: {e}'
+        return page_result
+    except RuntimeError as e:
+        # pytesseract kills tesseract and raises a plain RuntimeError when the timeout is hit
+        page_result['error'] = f'OCR timed out: {e}'
+        return page_result
+    
+    scale = 72.0 / dpi
+    lines = {}
+    for i, word in enumerate(data['text']):
+        word = word.strip()
+        if not word:
+            continue
+        left, top = data['left'][i], data['top'][i]
+        width, height = data['width'][i], data['height'][i]
+        line_key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        page_result['words'].append({
+            'text': word,
+            'bbox': [round(left * scale, 2), round(top * scale, 2),
+                     round((left + width) * scale, 2), round((top + height) * scale, 2)],
+            'conf': float(data['conf'][i]),
+            'line': list(line_key)
+        })
+        lines.setdefault(line_key, []).append(word)
+    page_result['text'] = "\n".join(" ".join(words) for words in lines.values())
+    return page_result
+
+def _init_ocr_worker() -> None:
+    # One page per worker already fills the cores; keep each tesseract single-threaded
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+def ocr_pdf_pages(pdf_path: str, dpi: int = OCR_DPI, timeout: int = OCR_PAGE_TIMEOUT,
+                  workers: int = OCR_WORKERS) -> List[Dict[str, Any]]:
+    """OCR every page of a PDF across a process pool, reporting page progress on stderr."""
+    try:
+        doc = fitz.open(pdf_path)
+        page_count = len(doc)
+        doc.close()
+    except Exception as e:
+        sys.stderr.write(f"Error opening PDF for OCR: {e}\n")
+        return []
+    if page_count == 0:
+        return []
+    
+    workers = max(1, min(workers, page_count))
+    if workers == 1:
+        pages = []
+        for i in range(page_count):
+            pages.append(ocr_pdf_page(pdf_path, i, dpi, timeout))
+            sys.stderr.write(f"OCR progress: {i + 1}/{page_count} pages\n")
+        return pages
+    
+    # Tesseract's own per-page timeout bounds each task, so no pool-level deadline is needed
+    pages: List[Dict[str, Any]] = [{}] * page_count
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_ocr_worker) as executor:
+        futures = {executor.submit(ocr_pdf_page, pdf_path, i, dpi, timeout): i for i in range(page_count)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                pages[i] = future.result()
+            except Exception as e:
+                pages[i] = {'page': i + 1, 'text': '', 'words': [], 'error': f'OCR failed: {e}'}
+            sys.stderr.write(f"OCR progress: {done}/{page_count} pages\n")
+    return pages
+
 def encode_pdf_first_page(pdf_path: str) -> str:
     """Convert first page of PDF to image and encode as base64."""
     try:
@@ -107,20 +212,6 @@ def encode_pdf_first_page(pdf_path: str) -> str:
         print(f"Error converting PDF to image: {e}")
         return ""
 
-def post_to_gemini(api_key: str, payload: Dict[str, Any], timeout: int = 30) -> Optional[Dict[str, Any]]:
-    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL}:generateContent?key={api_key}"
-    headers = {"Content-Type": "application/json"}
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        if resp.status_code != 200:
-            print(f"Gemini API error: status={resp.status_code}")
-            print(resp.text)
-            return None
-        return resp.json()
-    except requests.exceptions.RequestException as e:
-        print("Gemini request failed:", repr(e))
-        return None
-
 def extract_text_from_response(body: Dict[str, Any]) -> Optional[str]:
     candidates = body.get('candidates', [])
     if not candidates:
@@ -199,11 +290,11 @@ Instructions:
 6. Return ONLY valid JSON, no additional text
 
 Statement text:
-{pdf_text[:8000]}  # Limit text to avoid token limits
+{pdf_text[:STATEMENT_TEXT_LIMIT]}  # Limit text to avoid token limits
 """
     return prompt
 
-def process_statement_with_text(api_key: str, pdf_text: str) -> Optional[Dict[str, Any]]:
+def process_statement_with_text(api_key: str, pdf_text: str, model: Optional[str] = None) -> Optional[Dict[str, Any]]:
     """Process statement using extracted text."""
     prompt = build_statement_prompt(pdf_text)
     
@@ -217,9 +308,9 @@ def process_statement_with_text(api_key: str, pdf_text: str) -> Optional[Dict[st
         ]
     }
     
-    body = post_to_gemini(api_key, payload, timeout=45)
+    body = post_to_gemini(api_key, payload, timeout=45, model=model)
     if not body:
-        return None
+        return NO_RESPONSE
     
     text = extract_text_from_response(body)
     if not text:
@@ -231,7 +322,8 @@ def process_statement_with_text(api_key: str, pdf_text: str) -> Optional[Dict[st
     
     return parsed
 
-def process_statement_with_image(api_key: str, image_base64: str, pdf_text: str) -> Optional[Dict[str, Any]]:
+def process_statement_with_image(api_key: str, image_base64: str, pdf_text: str,
+                                 model: Optional[str] = None) -> Optional[Dict[str, Any]]:
     """Process statement using both image and text for better accuracy."""
     income_categories = ", ".join(INCOME_SUBCLASSES)
     expense_categories = ", ".join(EXPENSE_SUBCLASSES)
@@ -281,9 +373,9 @@ Additional text context: {pdf_text[:2000]}
         ]
     }
     
-    body = post_to_gemini(api_key, payload, timeout=60)
+    body = post_to_gemini(api_key, payload, timeout=60, model=model)
     if not body:
-        return None
+        return NO_RESPONSE
     
     text = extract_text_from_response(body)
     if not text:
@@ -291,6 +383,52 @@ Additional text context: {pdf_text[:2000]}
     
     return extract_json_from_text(text)
 
+LOCAL_TX_LINE = re.compile(
+    r'^\s*(\d{4}-\d{2}-\d{2}|\d{1,2}[/-]\d{1,2}[/-]\d{4}|\d{1,2}-[A-Za-z]{3}-\d{4})\s+'
+    r'(.+?)\s+(-?[\d,]+\.\d{2})(?:\s*(CR|DR|Cr|Dr))?(?:\s+(-?[\d,]+\.\d{2}))?\s*$'
+)
+LOCAL_CREDIT_HINTS = ('salary', 'deposit', 'refund', 'interest', 'credit', 'transfer in')
+
+def parse_statement_locally(pdf_text: str) -> Dict[str, Any]:
+    """Regex-based transaction extraction, used when Gemini is unavailable."""
+    transactions = []
+    for line in pdf_text.splitlines():
+        m = LOCAL_TX_LINE.match(line)
+        if not m:
+            continue
+        date_str, description, amount_str, marker, balance_str = m.groups()
+        amount = float(amount_str.replace(',', ''))
+        is_credit = (marker or '').upper() == 'CR' or (
+            amount > 0 and not marker and any(h in description.lower() for h in LOCAL_CREDIT_HINTS)
+        )
+        transactions.append({
+            'date': date_str,
+            'description': description.strip(),
+            'debit': None if is_credit else abs(amount),
+            'credit': abs(amount) if is_credit else None,
+            'amount': abs(amount),
+            'balance': float(balance_str.replace(',', '')) if balance_str else None,
+            'category': 'other_income' if is_credit else 'other_expenses',
+            'confidence': 'low'
+        })
+    return {'transactions': transactions}
+
+def statement_escalation_reason(data: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Return why a parsed statement should go to the next model tier, or None to accept it."""
+    if data is NO_RESPONSE:
+        return 'no response'
+    if not isinstance(data, dict):
+        return 'unparseable JSON'
+    transactions = data.get('transactions')
+    if not isinstance(transactions, list) or not transactions:
+        return 'empty transactions'
+    if any(not isinstance(tx, dict) or tx.get('category') not in ALL_CATEGORIES for tx in transactions):
+        return 'invalid categories'
+    low = sum(1 for tx in transactions if str(tx.get('confidence', '')).lower() == 'low')
+    if low / len(transactions) > MAX_LOW_CONFIDENCE_RATIO:
+        return f'{low}/{len(transactions)} low-confidence transactions'
+    return None
+
 def validate_and_clean_transactions(data: Dict[str, Any]) -> Dict[str, Any]:
     """Validate and clean transaction data."""
     if 'transactions' not in data:
@@ -347,38 +485,185 @@ def validate_and_clean_transactions(data: Dict[str, Any]) -> Dict[str, Any]:
     data['transactions'] = cleaned_transactions
     return data
 
-def process_statement_pdf(api_key: str, pdf_path: str) -> Optional[Dict[str, Any]]:
-    """Main function to process statement PDF."""
+def split_text(text: str, limit: Optional[int] = None) -> List[str]:
+    """Split text on line boundaries into pieces of at most limit characters."""
+    limit = limit or STATEMENT_TEXT_LIMIT
+    pieces = []
+    current = ''
+    for line in text.splitlines():
+        while len(line) > limit:
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            pieces.append(current)
+            current = ''
+        current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_page_texts(page_texts: List[str], limit: Optional[int] = None) -> List[str]:
+    """Group page texts in order into chunks that each fit in one prompt."""
+    limit = limit or STATEMENT_TEXT_LIMIT
+    chunks = []
+    current = ''
+    for text in page_texts:
+        for piece in ([text] if len(text) <= limit else split_text(text, limit)):
+            if current and len(current) + 2 + len(piece) > limit:
+                chunks.append(current)
+                current = ''
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def merge_statement_results(base: Optional[Dict[str, Any]], extra: Dict[str, Any]) -> Dict[str, Any]:
+    """Append a later chunk's transactions; header fields come from the first chunk that has them."""
+    if base is None:
+        return extra
+    base['transactions'] = (base.get('transactions') or []) + (extra.get('transactions') or [])
+    for key in ('accountNumber', 'period', 'openingBalance'):
+        if base.get(key) in (None, '') and extra.get(key) not in (None, ''):
+            base[key] = extra[key]
+    if extra.get('closingBalance') not in (None, ''):
+        base['closingBalance'] = extra['closingBalance']
+    return base
+
+def process_statement_with_tiers(api_key: str, pdf_text: str,
+                                 pdf_path: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], int, List[str], bool]:
+    """Run the model ladder over one piece of statement text.
+
+    Returns (result, tier, escalations, answered); answered is False when Gemini
+    itself did not respond. The first-page image is only tried when pdf_path is given.
+    """
+    result = None
+    result_tier = 0
+    escalations = []
+    tiers = MODEL_TIERS
+    for tier, model in enumerate(tiers):
+        # Try text-based processing first (faster)
+        candidate = process_statement_with_text(api_key, pdf_text, model=model)
+        reason = statement_escalation_reason(candidate)
+        if candidate is NO_RESPONSE:
+            # The endpoint failed, not the model; a bigger model would only wait longer
+            escalations.append(f'{model}: {reason}')
+            return result, result_tier, escalations, False
+        
+        # If text processing still fails or returns no transactions on the top tier, try with image.
+        # Cheaper tiers escalate straight away so a bad statement costs one extra call, not one per tier.
+        if pdf_path and reason in ('unparseable JSON', 'empty transactions') and tier == len(tiers) - 1:
+            image_base64 = encode_pdf_first_page(pdf_path)
+            if image_base64:
+                image_candidate = process_statement_with_image(api_key, image_base64, pdf_text, model=model)
+                if isinstance(image_candidate, dict) and image_candidate is not NO_RESPONSE:
+                    candidate = image_candidate
+                    reason = statement_escalation_reason(candidate)
+        
+        if isinstance(candidate, dict) and (result is None or candidate.get('transactions')):
+            result, result_tier = candidate, tier
+        if reason is None:
+            break
+        escalations.append(f'{model}: {reason}')
+    return result, result_tier, escalations, True
+
+def process_statement_pdf(api_key: str, pdf_path: str, ocr_words_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Main function to process statement PDF.
+
+    For scanned PDFs, per-page OCR text and word boxes are written to
+    ocr_words_path when given; they are too large to include in the result.
+    """
     # Remove debug prints that interfere with JSON output
     # Only output to stderr for debugging when called from Node.js
     
     # Extract text from PDF
     pdf_text = extract_text_from_pdf(pdf_path)
+    text_source = 'pdf_text'
+    ocr_pages = None
+    chunks = [pdf_text]
+    
+    # Scanned statements have no text layer; OCR the pages locally and send them
+    # to Gemini in page groups so pages past the prompt limit are not dropped
+    if not pdf_text.strip():
+        ocr_pages = ocr_pdf_pages(pdf_path)
+        page_texts = [page['text'] for page in ocr_pages if page['text']]
+        pdf_text = "\n\n".join(page_texts)
+        chunks = chunk_page_texts(page_texts)
+        text_source = 'local_ocr'
     if not pdf_text.strip():
         return {"error": "Could not extract text from PDF"}
     
-    # Try text-based processing first (faster)
-    result = process_statement_with_text(api_key, pdf_text)
+    result = None
+    gemini_tiers = []
+    escalations = []
+    local_chunks = []
+    text_sent_length = 0
+    gemini_available = True
+    for i, chunk in enumerate(chunks):
+        chunk_result = None
+        if gemini_available:
+            chunk_result, chunk_tier, chunk_escalations, gemini_available = process_statement_with_tiers(
+                api_key, chunk, pdf_path if i == 0 else None
+            )
+            prefix = f'chunk {i + 1}: ' if len(chunks) > 1 else ''
+            escalations.extend(prefix + e for e in chunk_escalations)
+            if chunk_result:
+                gemini_tiers.append(chunk_tier)
+                text_sent_length += min(len(chunk), STATEMENT_TEXT_LIMIT)
+        if not chunk_result:
+            # Gemini could not handle this chunk; parse it locally so its transactions are kept
+            chunk_result = parse_statement_locally(chunk)
+            local_chunks.append(i + 1)
+        result = merge_statement_results(result, chunk_result)
     
-    # If text processing fails or returns insufficient data, try with image
-    if not result or not result.get('transactions') or len(result.get('transactions', [])) < 1:
-        image_base64 = encode_pdf_first_page(pdf_path)
-        if image_base64:
-            result = process_statement_with_image(api_key, image_base64, pdf_text)
-    
-    if not result:
-        return {"error": "Failed to process statement", "raw_text": pdf_text[:1000]}
+    if not gemini_tiers:
+        method = 'local_parse'
+    elif local_chunks:
+        method = 'gemini_ai+local_parse'
+    else:
+        method = 'gemini_ai'
+    if not result or not result.get('transactions'):
+        if not gemini_tiers:
+            return {
+                "error": "Failed to process statement",
+                "raw_text": pdf_text[:1000],
+                "processing_info": {'circuit_breaker': circuit_breaker.current_state()}
+            }
+        result = result or {}
     
     # Validate and clean the result
     result = validate_and_clean_transactions(result)
     
     # Add processing metadata
+    result_tier = max(gemini_tiers) if gemini_tiers else None
     result['processing_info'] = {
-        'method': 'gemini_ai',
+        'method': method,
+        'text_source': text_source,
         'text_length': len(pdf_text),
+        'text_sent_length': text_sent_length,
+        'text_chunks': len(chunks),
+        'local_parse_chunks': local_chunks,
         'processed_at': datetime.datetime.now().isoformat(),
-        'transaction_count': len(result.get('transactions', []))
+        'transaction_count': len(result.get('transactions', [])),
+        'model': MODEL_TIERS[result_tier] if result_tier is not None else None,
+        'model_tier': result_tier,
+        'model_escalations': escalations,
+        'circuit_breaker': circuit_breaker.current_state()
     }
+    if ocr_pages is not None:
+        result['processing_info']['ocr_page_count'] = len(ocr_pages)
+        result['processing_info']['ocr_page_errors'] = [
+            {'page': page['page'], 'error': page['error']} for page in ocr_pages if page.get('error')
+        ]
+        if ocr_words_path:
+            try:
+                with open(ocr_words_path, 'w') as f:
+                    json.dump(ocr_pages, f)
+                result['processing_info']['ocr_words_path'] = ocr_words_path
+            except OSError as e:
+                result['processing_info']['ocr_words_error'] = f'Could not write OCR words: {e}'
     
     return result
 
@@ -386,8 +671,13 @@ def main():
     parser = argparse.ArgumentParser(description='Bank Statement OCR + categorization using Gemini')
     parser.add_argument('pdf_path', nargs='?', help='Path to statement PDF')
     parser.add_argument('--save', '-s', help='Path to save JSON output')
+    parser.add_argument('--models', help='Comma-separated model ladder, cheapest first')
+    parser.add_argument('--ocr-words', help='For scanned PDFs, save per-page OCR text and word boxes to this JSON file')
     args = parser.parse_args()
 
+    if args.models:
+        set_model_tiers(args.models)
+
     api_key = load_api_key()
     if not api_key:
         # Only output JSON, send errors to stderr
@@ -409,7 +699,7 @@ def main():
         print(json.dumps(result, indent=2))
         return
 
-    result = process_statement_pdf(api_key, pdf_path)
+    result = process_statement_pdf(api_key, pdf_path, ocr_words_path=args.ocr_words)
     if result is None:
         result = {"error": "Failed to process statement PDF"}
 
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The OCR scripts are run directly by the Node controllers, so import them as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# imported after the path tweak above
+import circuit_breaker  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_breaker_state(tmp_path, monkeypatch):
+    """Keep breaker state per test instead of in the shared temp-dir file."""
+    monkeypatch.setattr(circuit_breaker, 'STATE_PATH', str(tmp_path / 'breaker.json'))
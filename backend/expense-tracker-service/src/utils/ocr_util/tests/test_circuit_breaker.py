@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+import circuit_breaker as cb
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cb.time, 'time', clock.time)
+    monkeypatch.setattr(cb, 'MIN_CALLS', 4)
+    monkeypatch.setattr(cb, 'FAILURE_RATIO', 0.5)
+    monkeypatch.setattr(cb, 'COOLDOWN_SECONDS', 60)
+    monkeypatch.setattr(cb, 'PROBE_TIMEOUT_SECONDS', 90)
+    return clock
+
+
+def trip(clock):
+    for _ in range(cb.MIN_CALLS):
+        cb.record_failure(cb.allow_request())
+
+
+def test_stays_closed_below_failure_ratio(clock):
+    for ok in (True, True, True, False, False):
+        ticket = cb.allow_request()
+        cb.record_success(ticket) if ok else cb.record_failure(ticket)
+    assert cb.current_state() == cb.CLOSED
+
+
+def test_opens_then_half_opens_after_cooldown(clock):
+    trip(clock)
+    assert cb.current_state() == cb.OPEN
+    assert cb.allow_request() is None
+
+    clock.now += 61
+    assert cb.current_state() == cb.HALF_OPEN
+    probe = cb.allow_request()
+    assert probe not in (None, cb.CALL_TICKET)
+    # only one probe in flight across workers
+    assert cb.allow_request() is None
+
+    cb.record_success(probe)
+    assert cb.current_state() == cb.CLOSED
+    assert cb.allow_request() == cb.CALL_TICKET
+
+
+def test_failed_probe_reopens(clock):
+    trip(clock)
+    clock.now += 61
+    cb.record_failure(cb.allow_request())
+    assert cb.current_state() == cb.OPEN
+    clock.now += 30
+    assert cb.allow_request() is None
+
+
+def test_stragglers_do_not_decide_half_open(clock):
+    straggler = cb.allow_request()
+    trip(clock)
+    clock.now += 61
+    probe = cb.allow_request()
+
+    cb.record_success(straggler)
+    assert cb.current_state() == cb.HALF_OPEN
+    cb.record_failure(straggler)
+    assert cb.current_state() == cb.HALF_OPEN
+
+    cb.record_success(probe)
+    assert cb.current_state() == cb.CLOSED
+
+
+def test_failures_while_open_keep_original_cooldown(clock):
+    stragglers = [cb.allow_request() for _ in range(3)]
+    trip(clock)
+    clock.now += 50
+    for ticket in stragglers:
+        cb.record_failure(ticket)
+    clock.now += 11
+    assert cb.current_state() == cb.HALF_OPEN
+    assert cb.allow_request() is not None
+
+
+def test_lost_probe_is_replaced_after_probe_timeout(clock):
+    trip(clock)
+    clock.now += 61
+    lost = cb.allow_request()
+    clock.now += 91
+    probe = cb.allow_request()
+    assert probe not in (None, lost)
+    cb.record_success(lost)
+    assert cb.current_state() == cb.HALF_OPEN
+
+
+def test_current_state_does_not_write(clock):
+    assert cb.current_state() == cb.CLOSED
+    assert not os.path.exists(cb.STATE_PATH)
+
+
+def test_allow_request_does_not_write_unless_claiming_probe(clock, monkeypatch):
+    writes = []
+    real_replace = cb.os.replace
+    monkeypatch.setattr(cb.os, 'replace', lambda *a: (writes.append(a), real_replace(*a)))
+
+    assert cb.allow_request() == cb.CALL_TICKET
+    assert writes == []
+    trip(clock)
+    writes.clear()
+    assert cb.allow_request() is None
+    assert writes == []
+    clock.now += 61
+    assert cb.allow_request() not in (None, cb.CALL_TICKET)
+    assert len(writes) == 1
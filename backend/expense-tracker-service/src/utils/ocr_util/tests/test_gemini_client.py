@@ -0,0 +1,52 @@
+import requests
+
+import circuit_breaker
+import gemini_client
+
+
+class FakeResponse:
+    status_code = 503
+    text = 'backend unavailable'
+
+
+def test_errors_go_to_stderr_and_count_against_breaker(monkeypatch, capsys):
+    monkeypatch.setattr(gemini_client.requests, 'post', lambda *a, **k: FakeResponse())
+    assert gemini_client.post_to_gemini('k', {}) is None
+
+    def timeout(*a, **k):
+        raise requests.exceptions.Timeout('slow')
+
+    monkeypatch.setattr(gemini_client.requests, 'post', timeout)
+    assert gemini_client.post_to_gemini('k', {}) is None
+
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'status=503' in err and 'Timeout' in err
+    assert len(circuit_breaker._read_state()['events']) == 2
+
+
+def test_open_breaker_skips_request(monkeypatch):
+    monkeypatch.setattr(circuit_breaker, 'allow_request', lambda: None)
+
+    def unexpected(*a, **k):
+        raise AssertionError('request should have been skipped')
+
+    monkeypatch.setattr(gemini_client.requests, 'post', unexpected)
+    assert gemini_client.post_to_gemini('k', {}) is None
+
+
+class GarbledResponse:
+    status_code = 200
+    text = '<html>'
+
+    def json(self):
+        raise requests.exceptions.JSONDecodeError('Expecting value', '<html>', 0)
+
+
+def test_garbled_200_records_one_failure(monkeypatch):
+    outcomes = []
+    monkeypatch.setattr(circuit_breaker, 'record_success', lambda ticket: outcomes.append(('ok', ticket)))
+    monkeypatch.setattr(circuit_breaker, 'record_failure', lambda ticket: outcomes.append(('fail', ticket)))
+    monkeypatch.setattr(gemini_client.requests, 'post', lambda *a, **k: GarbledResponse())
+    assert gemini_client.post_to_gemini('k', {}) is None
+    assert outcomes == [('fail', circuit_breaker.CALL_TICKET)]
@@ -0,0 +1,124 @@
+import json
+
+import gemini_ocr
+
+
+def gemini_body(obj):
+    return {'candidates': [{'content': {'parts': [{'text': json.dumps(obj)}]}}]}
+
+
+def receipt(merchant, category='groceries'):
+    return {'merchant': merchant, 'items': [], 'total': 1.0, 'category': category}
+
+
+def stub_gemini(monkeypatch, batch_reply):
+    """Answer batched requests with batch_reply and single-image requests per image data."""
+    calls = []
+
+    def fake_post(api_key, payload, timeout=30, model=None):
+        parts = payload['contents'][0]['parts']
+        images = [p['inline_data']['data'] for p in parts if 'inline_data' in p]
+        calls.append(images)
+        if len(images) > 1:
+            return gemini_body(batch_reply)
+        return gemini_body(receipt('single-' + images[0]))
+
+    monkeypatch.setattr(gemini_ocr, 'post_to_gemini', fake_post)
+    monkeypatch.setattr(gemini_ocr, 'encode_image', lambda path: 'enc-' + path)
+    return calls
+
+
+def test_plan_batches_bounds_count_and_bytes():
+    images = ['x' * 5] * 7
+    assert gemini_ocr.plan_batches(images, batch_size=3, max_bytes=100) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert gemini_ocr.plan_batches(images, batch_size=10, max_bytes=12) == [[0, 1], [2, 3], [4, 5], [6]]
+
+
+def test_plan_batches_keeps_oversized_image_alone():
+    assert gemini_ocr.plan_batches(['x' * 50, 'x'], batch_size=5, max_bytes=10) == [[0], [1]]
+
+
+def test_batch_maps_entries_by_image_index(monkeypatch):
+    reply = [dict(receipt('C'), image_index=2), dict(receipt('A'), image_index=0), dict(receipt('B'), image_index=1)]
+    calls = stub_gemini(monkeypatch, reply)
+    results = gemini_ocr.process_image_batch('k', ['a', 'b', 'c'], ['ea', 'eb', 'ec'])
+    assert [r['merchant'] for r in results] == ['A', 'B', 'C']
+    assert len(calls) == 1
+
+
+def test_batch_retries_unindexed_entries_when_one_is_dropped(monkeypatch):
+    calls = stub_gemini(monkeypatch, [receipt('A'), receipt('C')])
+    results = gemini_ocr.process_image_batch('k', ['a', 'b', 'c'], ['ea', 'eb', 'ec'])
+    assert [r['merchant'] for r in results] == ['single-ea', 'single-eb', 'single-ec']
+    assert calls[1:] == [['ea'], ['eb'], ['ec']]
+
+
+def test_batch_uses_position_when_every_entry_is_unindexed(monkeypatch):
+    stub_gemini(monkeypatch, [receipt('A'), receipt('B')])
+    results = gemini_ocr.process_image_batch('k', ['a', 'b'], ['ea', 'eb'])
+    assert [r['merchant'] for r in results] == ['A', 'B']
+
+
+def test_batch_retries_missing_and_invalid_entries(monkeypatch):
+    reply = [dict(receipt('A'), image_index=0), {'image_index': 1}, dict(receipt('X'), image_index='oops')]
+    calls = stub_gemini(monkeypatch, reply)
+    results = gemini_ocr.process_image_batch('k', ['a', 'b', 'c'], ['ea', 'eb', 'ec'])
+    assert [r['merchant'] for r in results] == ['A', 'single-eb', 'single-ec']
+    # retries reuse the already-encoded images
+    assert calls[1:] == [['eb'], ['ec']]
+
+
+def test_process_image_escalates_to_next_tier_on_invalid_category(monkeypatch):
+    models = []
+
+    def fake_post(api_key, payload, timeout=30, model=None):
+        models.append(model)
+        return gemini_body(receipt('A', 'bogus' if model == gemini_ocr.MODEL_TIERS[0] else 'groceries'))
+
+    monkeypatch.setattr(gemini_ocr, 'post_to_gemini', fake_post)
+    result = gemini_ocr.process_image('k', 'a', image_base64='ea')
+    assert models == gemini_ocr.MODEL_TIERS
+    assert result['model_tier'] == len(gemini_ocr.MODEL_TIERS) - 1
+    assert result['category'] == 'groceries'
+    assert result['model_escalations'] == [f'{gemini_ocr.MODEL_TIERS[0]}: invalid overall category']
+
+
+def test_process_image_tags_unparseable_replies(monkeypatch):
+    def fake_post(api_key, payload, timeout=30, model=None):
+        return {'candidates': [{'content': {'parts': [{'text': 'not json'}]}}]}
+
+    monkeypatch.setattr(gemini_ocr, 'post_to_gemini', fake_post)
+    result = gemini_ocr.process_image('k', 'a', image_base64='ea')
+    assert result['raw_text'] == 'not json'
+    assert result['model_tier'] == 0
+    assert len(result['model_escalations']) == len(gemini_ocr.MODEL_TIERS)
+
+
+def test_batch_retries_entries_with_non_dict_items(monkeypatch):
+    reply = [dict(receipt('A'), image_index=0), {'image_index': 1, 'merchant': 'B', 'items': ['milk']}]
+    calls = stub_gemini(monkeypatch, reply)
+    results = gemini_ocr.process_image_batch('k', ['a', 'b'], ['ea', 'eb'])
+    assert [r['merchant'] for r in results] == ['A', 'single-eb']
+    assert calls[1:] == [['eb']]
+
+
+def test_non_dict_items_escalate_instead_of_crashing(monkeypatch):
+    def fake_post(api_key, payload, timeout=30, model=None):
+        return gemini_body({'merchant': 'A', 'items': ['milk'], 'category': 'groceries'})
+
+    monkeypatch.setattr(gemini_ocr, 'post_to_gemini', fake_post)
+    result = gemini_ocr.process_image('k', 'a', image_base64='ea')
+    assert result['model_escalations'][0].endswith('invalid item categories')
+    assert result['category_source'] == 'local_fallback'
+
+
+def test_process_image_does_not_escalate_when_endpoint_fails(monkeypatch):
+    models = []
+
+    def fake_post(api_key, payload, timeout=30, model=None):
+        models.append(model)
+        return None
+
+    monkeypatch.setattr(gemini_ocr, 'post_to_gemini', fake_post)
+    assert gemini_ocr.process_image('k', 'a', image_base64='ea') is None
+    assert models == [gemini_ocr.MODEL_TIERS[0]]
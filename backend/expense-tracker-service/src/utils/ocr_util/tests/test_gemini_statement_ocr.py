@@ -0,0 +1,55 @@
+import gemini_statement_ocr as st
+
+
+def tx(category='groceries', confidence='high'):
+    return {'date': '2024-01-02', 'description': 'Shop', 'debit': 5.0, 'amount': 5.0,
+            'category': category, 'confidence': confidence}
+
+
+def test_escalation_reason():
+    assert st.statement_escalation_reason(None) == 'unparseable JSON'
+    assert st.statement_escalation_reason({'transactions': []}) == 'empty transactions'
+    assert st.statement_escalation_reason({'transactions': [tx('bogus')]}) == 'invalid categories'
+    assert st.statement_escalation_reason({'transactions': [tx(confidence='low'), tx()]}) is not None
+    assert st.statement_escalation_reason({'transactions': [tx(confidence='low')] + [tx()] * 4}) is None
+
+
+def test_image_path_only_runs_on_last_tier(monkeypatch):
+    calls = []
+
+    def fake_text(api_key, pdf_text, model=None):
+        calls.append(('text', model))
+        return {'transactions': []}
+
+    def fake_image(api_key, image_base64, pdf_text, model=None):
+        calls.append(('image', model))
+        return {'transactions': [tx()]}
+
+    monkeypatch.setattr(st, 'extract_text_from_pdf', lambda path: 'statement text')
+    monkeypatch.setattr(st, 'encode_pdf_first_page', lambda path: 'img')
+    monkeypatch.setattr(st, 'process_statement_with_text', fake_text)
+    monkeypatch.setattr(st, 'process_statement_with_image', fake_image)
+    result = st.process_statement_pdf('k', 'statement.pdf')
+
+    tiers = st.MODEL_TIERS
+    assert calls == [('text', m) for m in tiers] + [('image', tiers[-1])]
+    assert result['processing_info']['model_tier'] == len(tiers) - 1
+    assert result['processing_info']['transaction_count'] == 1
+
+
+def test_no_response_goes_to_fallback_without_escalating(monkeypatch):
+    models = []
+
+    def fake_post(api_key, payload, timeout=30, model=None):
+        models.append(model)
+        return None
+
+    monkeypatch.setattr(st, 'extract_text_from_pdf', lambda path: '2024-01-02 Grocery Store 45.10 1,000.00')
+    monkeypatch.setattr(st, 'encode_pdf_first_page', lambda path: 'img')
+    monkeypatch.setattr(st, 'post_to_gemini', fake_post)
+    result = st.process_statement_pdf('k', 'statement.pdf')
+
+    assert models == [st.MODEL_TIERS[0]]
+    info = result['processing_info']
+    assert info['method'] == 'local_parse'
+    assert info['model_escalations'] == [f'{st.MODEL_TIERS[0]}: no response']
@@ -0,0 +1,126 @@
+import fitz
+import pytest
+
+import gemini_statement_ocr as st
+
+
+def ocr_data(words):
+    """Build a pytesseract image_to_data dict; words are (text, left, top, line_num)."""
+    data = {k: [] for k in ('text', 'left', 'top', 'width', 'height', 'block_num', 'par_num', 'line_num', 'conf')}
+    for text, left, top, line in words:
+        data['text'].append(text)
+        data['left'].append(left)
+        data['top'].append(top)
+        data['width'].append(100)
+        data['height'].append(50)
+        data['block_num'].append(1)
+        data['par_num'].append(1)
+        data['line_num'].append(line)
+        data['conf'].append('90' if text.strip() else '-1')
+    return data
+
+
+@pytest.fixture
+def scanned_pdf(tmp_path):
+    path = tmp_path / 'scan.pdf'
+    doc = fitz.open()
+    for _ in range(3):
+        doc.new_page(width=100, height=100)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def test_page_text_is_rebuilt_by_line_with_boxes_in_points(monkeypatch, scanned_pdf):
+    words = [('2024-01-02', 0, 0, 1), ('Shop', 150, 0, 1), ('12.00', 300, 0, 1), (' ', 0, 0, 1), ('Total', 0, 100, 2)]
+    monkeypatch.setattr(st.pytesseract, 'image_to_data', lambda img, output_type, timeout: ocr_data(words))
+    page = st.ocr_pdf_page(scanned_pdf, 0, dpi=144)
+    assert page['text'] == '2024-01-02 Shop 12.00\nTotal'
+    assert page['words'][1]['bbox'] == [75.0, 0.0, 125.0, 25.0]
+    assert 'error' not in page
+
+
+def test_timeout_and_render_errors_are_reported_separately(monkeypatch, scanned_pdf, tmp_path):
+    def timed_out(img, output_type, timeout):
+        raise RuntimeError('Tesseract process timeout')
+
+    monkeypatch.setattr(st.pytesseract, 'image_to_data', timed_out)
+    assert st.ocr_pdf_page(scanned_pdf, 0)['error'].startswith('OCR timed out')
+
+    def failed(img, output_type, timeout):
+        raise st.pytesseract.TesseractError(1, 'bad image')
+
+    monkeypatch.setattr(st.pytesseract, 'image_to_data', failed)
+    assert st.ocr_pdf_page(scanned_pdf, 0)['error'].startswith('OCR failed')
+
+    broken = tmp_path / 'broken.pdf'
+    broken.write_bytes(b'%PDF-1.4 not really')
+    assert st.ocr_pdf_page(str(broken), 0)['error'].startswith('Could not render page')
+
+
+def test_pages_keep_order_and_report_progress(monkeypatch, scanned_pdf, capsys):
+    monkeypatch.setattr(st.pytesseract, 'image_to_data',
+                        lambda img, output_type, timeout: ocr_data([('word', 0, 0, 1)]))
+    pages = st.ocr_pdf_pages(scanned_pdf, dpi=72, workers=1)
+    assert [p['page'] for p in pages] == [1, 2, 3]
+    assert 'OCR progress: 3/3 pages' in capsys.readouterr().err
+
+
+def test_word_boxes_go_to_sidecar_not_result(monkeypatch, scanned_pdf, tmp_path):
+    pages = [{'page': 1, 'text': '2024-01-02 Shop 12.00', 'words': [{'text': 'Shop'}]}]
+    monkeypatch.setattr(st, 'ocr_pdf_pages', lambda path: pages)
+    monkeypatch.setattr(st, 'process_statement_with_text', lambda *a, **k: None)
+    monkeypatch.setattr(st, 'process_statement_with_image', lambda *a, **k: None)
+    sidecar = tmp_path / 'words.json'
+
+    result = st.process_statement_pdf('k', scanned_pdf, ocr_words_path=str(sidecar))
+    assert 'ocr_pages' not in result
+    assert result['processing_info']['text_source'] == 'local_ocr'
+    assert result['processing_info']['ocr_words_path'] == str(sidecar)
+    assert sidecar.read_text().count('Shop') == 2
+    assert result['transactions'][0]['description'] == 'Shop'
+
+
+def test_chunk_page_texts_groups_pages_under_limit():
+    assert st.chunk_page_texts(['a' * 4, 'b' * 4, 'c' * 4], limit=10) == ['aaaa\n\nbbbb', 'cccc']
+    long_page = '\n'.join(['x' * 6] * 3)
+    assert st.chunk_page_texts([long_page], limit=10) == ['x' * 6] * 3
+    assert all(len(c) <= 10 for c in st.chunk_page_texts(['y' * 25], limit=10))
+
+
+def test_scanned_pages_past_prompt_limit_reach_gemini_or_local_parse(monkeypatch, scanned_pdf):
+    page_lines = ['2024-01-0%d Shop%d 1%d.00' % (n, n, n) for n in (1, 2, 3)]
+    pages = [{'page': n + 1, 'text': line, 'words': []} for n, line in enumerate(page_lines)]
+    monkeypatch.setattr(st, 'ocr_pdf_pages', lambda path: pages)
+    monkeypatch.setattr(st, 'STATEMENT_TEXT_LIMIT', len(page_lines[0]) + 5)
+    monkeypatch.setattr(st, 'encode_pdf_first_page', lambda path: '')
+    prompts = []
+
+    def fake_text(api_key, pdf_text, model=None):
+        prompts.append(pdf_text)
+        if 'Shop3' in pdf_text:
+            return None  # unusable reply on the last chunk
+        desc = pdf_text.split()[1]
+        return {'accountNumber': '42', 'transactions': [
+            {'date': '2024-01-01', 'description': desc, 'amount': 1.0, 'debit': 1.0,
+             'category': 'groceries', 'confidence': 'high'}]}
+
+    monkeypatch.setattr(st, 'process_statement_with_text', fake_text)
+    result = st.process_statement_pdf('k', scanned_pdf)
+
+    assert [t['description'] for t in result['transactions']] == ['Shop1', 'Shop2', 'Shop3']
+    info = result['processing_info']
+    assert info['text_chunks'] == 3
+    assert info['local_parse_chunks'] == [3]
+    assert info['method'] == 'gemini_ai+local_parse'
+    assert info['text_sent_length'] == len(page_lines[0]) + len(page_lines[1])
+    assert result['accountNumber'] == '42'
+
+
+def test_unwritable_sidecar_is_reported_not_raised(monkeypatch, scanned_pdf, tmp_path):
+    pages = [{'page': 1, 'text': '2024-01-02 Shop 12.00', 'words': []}]
+    monkeypatch.setattr(st, 'ocr_pdf_pages', lambda path: pages)
+    monkeypatch.setattr(st, 'process_statement_with_text', lambda *a, **k: st.NO_RESPONSE)
+    result = st.process_statement_pdf('k', scanned_pdf, ocr_words_path=str(tmp_path / 'missing' / 'w.json'))
+    assert 'ocr_words_path' not in result['processing_info']
+    assert result['processing_info']['ocr_words_error'].startswith('Could not write OCR words')